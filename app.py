@@ -1,12 +1,29 @@
-from flask import Flask, render_template, jsonify, request, redirect, url_for
+from flask import Flask, render_template, request, redirect, url_for
 import tinytuya
 import time
 from datetime import datetime, timedelta
-import json
 import os
+import orjson
 import threading
-from collections import defaultdict
-from functools import lru_cache
+import sqlite3
+import atexit
+import queue
+from collections import deque
+import numpy as np
+
+try:
+    from numba import njit
+    HAVE_NUMBA = True
+except ImportError:
+    HAVE_NUMBA = False
+
+try:
+    from flask_compress import Compress
+except ImportError:
+    Compress = None
+
+# np.trapz was renamed to np.trapezoid in NumPy 2.0 and later removed
+trapezoid = getattr(np, 'trapezoid', None) or np.trapz
 
 # Configuration - can be set via environment variables
 DEVICE_ID = os.getenv('DEVICE_ID', 'bf493814f4d1067dcbqvx5')
@@ -15,9 +32,40 @@ VERSION = os.getenv('VERSION', '3.5')
 
 # Initialize Flask
 app = Flask(__name__, template_folder='templates')
-JSON_FILE = 'energy_data.json'
+app.config.update(
+    COMPRESS_MIMETYPES=['application/json'],
+    COMPRESS_ALGORITHM=['br', 'gzip'],
+    COMPRESS_LEVEL=4,  # gzip level; balances CPU against ratio
+    COMPRESS_BR_LEVEL=4,
+    COMPRESS_MIN_SIZE=1024
+)
+if Compress:
+    # Without Flask-Compress, let a reverse proxy compress instead
+    Compress(app)
+JSON_FILE = 'energy_data.json'  # Export snapshot of the retained window
+JSONL_FILE = 'energy_data.jsonl'  # Append-only log, one entry per line
+DB_FILE = 'energy.db'
 STORAGE_INTERVAL = 300  # 5 minutes
-file_lock = threading.Lock()
+RETENTION_DAYS = 30
+# One reading per interval over the retention window, plus some slack
+HISTORY_CAPACITY = RETENTION_DAYS * 86400 // STORAGE_INTERVAL + 64
+STATUS_CACHE_TTL = 10  # Seconds a device status reading is reused
+STATUS_WAIT_TIMEOUT = 2.0  # Max seconds to wait on another thread's refresh
+PURGE_INTERVAL = 3600  # Purge old readings once per hour
+COMPACT_INTERVAL = 86400  # Trim the JSONL log and refresh the export daily
+WRITE_QUEUE_SIZE = 1024
+JSONL_FLUSH_EVERY = 12  # Flush buffered log entries every 12 saves (1 hour)
+log_lock = threading.Lock()
+db_local = threading.local()
+pending_entries = deque()
+write_queue = queue.Queue(maxsize=WRITE_QUEUE_SIZE)
+status_cache = {'ts': 0.0, 'val': {}}
+status_lock = threading.Lock()
+status_idle = threading.Event()  # Cleared while a device refresh is in flight
+status_idle.set()
+analysis_cache = {}
+analysis_lock = threading.Lock()
+ANALYSIS_CACHE_SIZE = 4
 
 # Device initialization with auto-discovery
 def initialize_device():
@@ -46,138 +94,509 @@ def initialize_device():
 
 device = initialize_device()
 
+def get_db():
+    """Return this thread's SQLite connection, opening it on first use"""
+    conn = getattr(db_local, 'conn', None)
+    if conn is None:
+        # Autocommit mode; writers open their own BEGIN IMMEDIATE transaction
+        conn = sqlite3.connect(DB_FILE, isolation_level=None)
+        conn.execute('PRAGMA journal_mode=WAL')
+        conn.execute('PRAGMA synchronous=NORMAL')
+        conn.execute('PRAGMA temp_store=MEMORY')
+        conn.execute('PRAGMA mmap_size=268435456')
+        db_local.conn = conn
+    return conn
+
+def init_db():
+    # ts is the rowid, so the primary key doubles as the time index
+    get_db().execute("""
+        CREATE TABLE IF NOT EXISTS readings (
+            ts INTEGER PRIMARY KEY,
+            current_ma REAL,
+            power_w REAL,
+            voltage_v REAL,
+            total_kwh REAL,
+            is_on INT
+        )
+    """)
+
+init_db()
+
+def entry_to_row(entry):
+    data = entry['data']
+    ts = entry.get('ts')
+    if ts is None:
+        # Entries written before 'ts' was stored only carry the ISO string
+        ts = int(datetime.fromisoformat(entry['timestamp']).timestamp())
+    return (ts, data['current_ma'], data['power_w'], data['voltage_v'],
+            data['total_kwh'], int(bool(data['is_on'])))
+
+def row_to_entry(row):
+    ts, current_ma, power_w, voltage_v, total_kwh, is_on = row
+    return {
+        'timestamp': datetime.fromtimestamp(ts).isoformat(),
+        'ts': ts,
+        'data': {
+            'current_ma': current_ma,
+            'power_w': power_w,
+            'voltage_v': voltage_v,
+            'total_kwh': total_kwh,
+            'is_on': bool(is_on)
+        }
+    }
+
+class History:
+    """Retained readings held column-wise in a fixed-capacity ring buffer
+
+    Each column is backed by an array of twice the capacity and the live
+    rows are always the contiguous slice [start:start + size]. Rows
+    arrive in time order, so a time window is a pair of searchsorted
+    lookups. Once full, every append expires the oldest row; when the
+    live slice reaches the end of the backing array it is copied to the
+    front of fresh storage, once per `capacity` appends. Slices handed
+    out by window() stay valid because written slots are never reused.
+
+    Readings are stored as float32, which is ample for the device's 1 mA,
+    0.1 W and 0.1 V resolution, and labels as ASCII bytes: 40 bytes per
+    row instead of a dict of Python objects.
+    """
+    COLUMNS = (
+        ('ts', np.int64),
+        ('current_ma', np.float32),
+        ('power_w', np.float32),
+        ('voltage_v', np.float32),
+        ('total_kwh', np.float32),
+        ('is_on', np.uint8),
+        # Local-time labels, formatted once at ingest
+        ('hhmm', 'S5'),
+        ('day', 'S10'),
+    )
+
+    def __init__(self, capacity):
+        self.lock = threading.RLock()
+        self.capacity = capacity
+        self.start = 0
+        self.size = 0
+        self.version = 0  # Bumped on every change, for cache keys
+        for name, dtype in self.COLUMNS:
+            setattr(self, name, np.empty(2 * capacity, dtype=dtype))
+
+    def _compact(self):
+        end = self.start + self.size
+        for name, dtype in self.COLUMNS:
+            column = np.empty(2 * self.capacity, dtype=dtype)
+            column[:self.size] = getattr(self, name)[self.start:end]
+            setattr(self, name, column)
+        self.start = 0
+
+    def append(self, row):
+        """Append a (ts, current_ma, power_w, voltage_v, total_kwh, is_on) row"""
+        moment = datetime.fromtimestamp(row[0])
+        row = (*row, moment.strftime('%H:%M'), moment.strftime('%Y-%m-%d'))
+        with self.lock:
+            if self.size == self.capacity:
+                self.start += 1
+                self.size -= 1
+            if self.start + self.size == 2 * self.capacity:
+                self._compact()
+            i = self.start + self.size
+            for (name, _), value in zip(self.COLUMNS, row):
+                getattr(self, name)[i] = value
+            self.size += 1
+            self.version += 1
+
+    def drop_before(self, cutoff):
+        with self.lock:
+            expired = int(np.searchsorted(self.ts[self.start:self.start + self.size], cutoff))
+            self.start += expired
+            self.size -= expired
+            self.version += 1
+
+    def window(self, start, end=None):
+        """Return column slices for readings with start <= ts < end"""
+        with self.lock:
+            first = self.start
+            last = self.start + self.size
+            ts = self.ts[first:last]
+            lo = first + int(np.searchsorted(ts, start))
+            hi = last if end is None else first + int(np.searchsorted(ts, end))
+            return {name: getattr(self, name)[lo:hi] for name, _ in self.COLUMNS}
+
+    def latest(self):
+        with self.lock:
+            if not self.size:
+                return None
+            i = self.start + self.size - 1
+            return {name: getattr(self, name)[i].item() for name, _ in self.COLUMNS}
+
+# In-memory copy of the retained readings, loaded once at startup
+history_store = History(HISTORY_CAPACITY)
+
+def import_legacy_json():
+    """Seed an empty database from the old full-array JSON file"""
+    if not os.path.exists(JSON_FILE):
+        return
+    conn = get_db()
+    try:
+        with conn:
+            conn.execute('BEGIN IMMEDIATE')
+            if conn.execute('SELECT 1 FROM readings LIMIT 1').fetchone():
+                return
+            with open(JSON_FILE, 'rb') as f:
+                legacy_data = orjson.loads(f.read())
+            conn.executemany('INSERT OR REPLACE INTO readings VALUES (?, ?, ?, ?, ?, ?)',
+                             [entry_to_row(entry) for entry in legacy_data])
+    except Exception as e:
+        print(f"Error importing {JSON_FILE}: {e}")
+
 def init_files():
     if not os.path.exists('templates'):
         os.makedirs('templates')
     if not os.path.exists('static'):
         os.makedirs('static')
-    if not os.path.exists(JSON_FILE):
-        with file_lock:
-            with open(JSON_FILE, 'w') as f:
-                json.dump([], f)
 
-@lru_cache(maxsize=1, typed=False)
-def get_cached_device_status():
-    """Cache device status for 10 seconds to reduce direct device calls"""
-    if not device:
-        return {}
+def atomic_write(path, payload):
+    """Replace path with payload so a crash never leaves a partial file"""
+    tmp_path = path + '.tmp'
+    fd = os.open(tmp_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o644)
     try:
-        return device.status().get('dps', {})
-    except:
-        return {}
+        view = memoryview(payload)
+        while view:
+            view = view[os.write(fd, view):]
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+    os.replace(tmp_path, path)
+
+def export_json(path=JSON_FILE):
+    """Write the retained readings to a JSON array in the original format"""
+    rows = get_db().execute('SELECT * FROM readings ORDER BY ts').fetchall()
+    atomic_write(path, orjson.dumps([row_to_entry(row) for row in rows]))
+
+def flush_pending_entries():
+    """Append all buffered entries to the JSONL log in a single write"""
+    with log_lock:
+        if not pending_entries:
+            return
+        payload = b''.join(orjson.dumps(entry) + b'\n' for entry in pending_entries)
+        with open(JSONL_FILE, 'ab') as f:
+            f.write(payload)
+        pending_entries.clear()
+
+atexit.register(flush_pending_entries)
 
-def save_energy_data(data):
+def trim_jsonl(cutoff):
+    """Drop log lines older than cutoff so the log stays within retention"""
+    with log_lock:
+        if not os.path.exists(JSONL_FILE):
+            return
+        with open(JSONL_FILE, 'rb') as f:
+            lines = f.read().splitlines(keepends=True)
+        # Lines are appended in time order, so only a prefix can expire
+        expired = 0
+        for line in lines:
+            try:
+                if entry_to_row(orjson.loads(line))[0] >= cutoff:
+                    break
+            except (orjson.JSONDecodeError, KeyError, TypeError, ValueError):
+                # A line torn by a crash mid-append is dropped as expired
+                pass
+            expired += 1
+        if expired:
+            atomic_write(JSONL_FILE, b''.join(lines[expired:]))
+
+def load_history():
+    cutoff = int(time.time()) - RETENTION_DAYS * 86400
+    rows = get_db().execute('SELECT * FROM readings WHERE ts >= ? ORDER BY ts', (cutoff,)).fetchall()
+    for row in rows:
+        history_store.append(row)
+
+def purge_old_data():
+    cutoff = int(time.time()) - RETENTION_DAYS * 86400
+    conn = get_db()
+    with conn:
+        conn.execute('BEGIN IMMEDIATE')
+        conn.execute('DELETE FROM readings WHERE ts < ?', (cutoff,))
+    history_store.drop_before(cutoff)
+
+def compact_files():
+    """Refresh the JSON export and trim the JSONL log to the retention window"""
     try:
-        with file_lock:
-            with open(JSON_FILE, 'r') as f:
-                existing_data = json.load(f)
-            
-            entry = {
-                'timestamp': datetime.now().isoformat(),
-                'data': {
-                    'current_ma': data.get('18', 0),
-                    'power_w': data.get('19', 0) / 10,
-                    'voltage_v': data.get('20', 0) / 10,
-                    'total_kwh': data.get('17', 0) / 1000,
-                    'is_on': bool(data.get('1', False))
-                }
-            }
-            
-            existing_data.append(entry)
-            
+        export_json()
+    except Exception as e:
+        print(f"Export error: {e}")
+    try:
+        trim_jsonl(int(time.time()) - RETENTION_DAYS * 86400)
+    except Exception as e:
+        print(f"Log trim error: {e}")
+
+def purge_loop():
+    last_compact_time = 0
+    while True:
+        try:
             # Keep only last 30 days of data
-            cutoff = datetime.now() - timedelta(days=30)
-            existing_data = [
-                entry for entry in existing_data 
-                if datetime.fromisoformat(entry['timestamp']) > cutoff
-            ]
-            
-            with open(JSON_FILE, 'w') as f:
-                json.dump(existing_data, f)
+            purge_old_data()
+        except Exception as e:
+            print(f"Purge error: {e}")
+        # Both files are rewritten in full, so only do it once per day
+        if time.time() - last_compact_time >= COMPACT_INTERVAL:
+            compact_files()
+            last_compact_time = time.time()
+        time.sleep(PURGE_INTERVAL)
+
+def refresh_device_status(max_age=0):
+    """Query the device unless the cached status is younger than max_age
+
+    Only one thread talks to the device at a time; concurrent callers
+    wait briefly for its result and fall back to the cached status.
+    """
+    with status_lock:
+        if time.monotonic() - status_cache['ts'] < max_age:
+            return status_cache['val']
+        leader = status_idle.is_set()
+        if leader:
+            status_idle.clear()
+    
+    if not leader:
+        status_idle.wait(timeout=STATUS_WAIT_TIMEOUT)
+        return status_cache['val']
+    
+    try:
+        value = {}
+        if device:
+            try:
+                value = device.status().get('dps', {})
+            except:
+                pass
+        status_cache.update(ts=time.monotonic(), val=value)
+        return value
+    finally:
+        status_idle.set()
+
+def get_cached_device_status():
+    """Cache device status for 10 seconds to reduce direct device calls"""
+    if time.monotonic() - status_cache['ts'] < STATUS_CACHE_TTL:
+        return status_cache['val']
+    return refresh_device_status(STATUS_CACHE_TTL)
+
+def invalidate_device_status():
+    status_cache['ts'] = 0.0
+
+def build_entry(data):
+    now = datetime.now()
+    return {
+        'timestamp': now.isoformat(),
+        'ts': int(now.timestamp()),
+        'data': {
+            'current_ma': data.get('18', 0),
+            'power_w': data.get('19', 0) / 10,
+            'voltage_v': data.get('20', 0) / 10,
+            'total_kwh': data.get('17', 0) / 1000,
+            'is_on': bool(data.get('1', False))
+        }
+    }
+
+def save_entries(entries):
+    try:
+        rows = [entry_to_row(entry) for entry in entries]
+        conn = get_db()
+        with conn:
+            conn.execute('BEGIN IMMEDIATE')
+            conn.executemany('INSERT OR REPLACE INTO readings VALUES (?, ?, ?, ?, ?, ?)', rows)
+        with log_lock:
+            pending_entries.extend(entries)
+            flush_due = len(pending_entries) >= JSONL_FLUSH_EVERY
+        for row in rows:
+            history_store.append(row)
+        
+        if flush_due:
+            flush_pending_entries()
     except Exception as e:
         print(f"Error saving data: {e}")
 
 def get_historical_data(days=1):
+    """Return the readings of the last `days` days with local day bounds
+
+    Day i covers indices bounds[i]:bounds[i + 1] of the column arrays.
+    """
     try:
-        with file_lock:
-            with open(JSON_FILE, 'r') as f:
-                all_data = json.load(f)
-        
-        cutoff = datetime.now() - timedelta(days=days)
-        recent_data = [
-            entry for entry in all_data 
-            if datetime.fromisoformat(entry['timestamp']) > cutoff
-        ]
+        cutoff = int(time.time()) - days * 86400
+        window = history_store.window(cutoff + 1)
+        ts = window['ts']
         
-        daily_data = defaultdict(lambda: {'power': [], 'voltage': [], 'current': [], 'timestamps': []})
+        if not ts.size:
+            return {}
         
-        for entry in recent_data:
-            date = datetime.fromisoformat(entry['timestamp']).strftime('%Y-%m-%d')
-            daily_data[date]['power'].append(entry['data']['power_w'])
-            daily_data[date]['voltage'].append(entry['data']['voltage_v'])
-            daily_data[date]['current'].append(entry['data']['current_ma'])
-            daily_data[date]['timestamps'].append(entry['timestamp'])
+        # Rows are time-ordered, so each day is one run of equal labels
+        day = window['day']
+        starts = np.flatnonzero(day[1:] != day[:-1]) + 1
+        bounds = np.concatenate(([0], starts, [ts.size]))
         
-        return daily_data
+        return {
+            'dates': day[bounds[:-1]].astype('U10').tolist(),
+            'bounds': bounds,
+            'power': window['power_w'],
+            'voltage': window['voltage_v'],
+            'current': window['current_ma'],
+            'timestamps': ts
+        }
     except Exception as e:
         print(f"Error reading data: {e}")
         return {}
 
+if HAVE_NUMBA:
+    @njit(cache=True, fastmath=True)
+    def fused_stats(values):
+        """Single-pass mean/max/min over a float32 array"""
+        value_min = values[0]
+        value_max = values[0]
+        total = 0.0
+        for value in values:
+            total += value
+            if value < value_min:
+                value_min = value
+            if value > value_max:
+                value_max = value
+        return total / values.size, value_max, value_min
+
+    # Not parallel=True: request threads call this concurrently, which
+    # aborts the process under Numba's workqueue threading layer
+    @njit(cache=True, fastmath=True)
+    def groupby_day(bounds, columns):
+        """Per-day (avg, max, min) of each row of `columns`"""
+        n_days = bounds.size - 1
+        stats = np.zeros((n_days, columns.shape[0], 3))
+        for day in range(n_days):
+            lo = bounds[day]
+            hi = bounds[day + 1]
+            if hi > lo:
+                for metric in range(columns.shape[0]):
+                    avg, value_max, value_min = fused_stats(columns[metric, lo:hi])
+                    stats[day, metric, 0] = avg
+                    stats[day, metric, 1] = value_max
+                    stats[day, metric, 2] = value_min
+        return stats
+else:
+    def groupby_day(bounds, columns):
+        """Per-day (avg, max, min) of each row of `columns` via ufunc.reduceat
+
+        Days must be non-empty: for equal bounds reduceat returns the
+        element at that index rather than an empty reduction.
+        """
+        starts = bounds[:-1]
+        sums = np.add.reduceat(columns, starts, axis=1, dtype=np.float64)
+        stats = np.stack((
+            sums / np.diff(bounds),
+            np.maximum.reduceat(columns, starts, axis=1),
+            np.minimum.reduceat(columns, starts, axis=1)
+        ), axis=-1)
+        return stats.transpose(1, 0, 2)
+
 def analyze_data(data):
     analysis = {}
-    for date, values in data.items():
-        if values['power']:
+    if not data:
+        return analysis
+    
+    bounds = data['bounds']
+    columns = np.vstack((data['power'], data['voltage'], data['current']))
+    stats = groupby_day(bounds, columns)
+    
+    for day, date in enumerate(data['dates']):
+        if bounds[day + 1] > bounds[day]:
+            power, voltage, current = stats[day]
             analysis[date] = {
                 'power': {
-                    'avg': round(sum(values['power'])/len(values['power']), 2),
-                    'max': round(max(values['power']), 2),
-                    'min': round(min(values['power']), 2)
+                    'avg': round(float(power[0]), 2),
+                    'max': round(float(power[1]), 2),
+                    'min': round(float(power[2]), 2)
                 },
                 'voltage': {
-                    'avg': round(sum(values['voltage'])/len(values['voltage']), 2),
-                    'max': round(max(values['voltage']), 2),
-                    'min': round(min(values['voltage']), 2)
+                    'avg': round(float(voltage[0]), 2),
+                    'max': round(float(voltage[1]), 2),
+                    'min': round(float(voltage[2]), 2)
                 },
                 'current': {
-                    'avg': round(sum(values['current'])/len(values['current'])/1000, 3),
-                    'max': round(max(values['current'])/1000, 3),
-                    'min': round(min(values['current'])/1000, 3)
+                    'avg': round(float(current[0])/1000, 3),
+                    'max': round(float(current[1])/1000, 3),
+                    'min': round(float(current[2])/1000, 3)
                 }
             }
     return analysis
 
-def monitor_energy():
+def get_cached_analysis(days):
+    """Reuse analyze_data() results until the history or time window moves"""
+    # The cutoff slides with the clock, so also key on the storage interval
+    key = (days, history_store.version, int(time.time()) // STORAGE_INTERVAL)
+    with analysis_lock:
+        analysis = analysis_cache.get(key)
+    if analysis is not None:
+        return analysis
+    
+    analysis = analyze_data(get_historical_data(days))
+    with analysis_lock:
+        analysis_cache[key] = analysis
+        while len(analysis_cache) > ANALYSIS_CACHE_SIZE:
+            del analysis_cache[next(iter(analysis_cache))]
+    return analysis
+
+def poll_device():
+    """Keep the status cache fresh and queue a reading every STORAGE_INTERVAL"""
     init_files()
     last_save_time = time.time()
     while True:
         try:
-            if time.time() - last_save_time >= STORAGE_INTERVAL:
-                # Clear cache to get fresh device data
-                get_cached_device_status.cache_clear()
-                data = get_cached_device_status()
-                if data:  # Only save if we got data
-                    save_energy_data(data)
-                    last_save_time = time.time()
-            time.sleep(60)
+            data = refresh_device_status()
+            if data and time.time() - last_save_time >= STORAGE_INTERVAL:
+                try:
+                    write_queue.put_nowait(build_entry(data))
+                except queue.Full:
+                    print("Write queue full, dropping reading")
+                last_save_time = time.time()
         except Exception as e:
-            print(f"Monitoring error: {e}")
+            print(f"Polling error: {e}")
+        time.sleep(STATUS_CACHE_TTL)
 
-monitor_thread = threading.Thread(target=monitor_energy)
-monitor_thread.daemon = True
-monitor_thread.start()
+def write_entries():
+    """Persist queued readings, batching whatever has piled up"""
+    while True:
+        batch = [write_queue.get()]
+        while True:
+            try:
+                batch.append(write_queue.get_nowait())
+            except queue.Empty:
+                break
+        save_entries(batch)
+
+# Seed the database before the purge thread re-exports the JSON file
+import_legacy_json()
+load_history()
+
+def json_response(obj, status=200):
+    """Serialize with orjson; NumPy arrays are encoded without tolist()"""
+    return app.response_class(orjson.dumps(obj, option=orjson.OPT_SERIALIZE_NUMPY),
+                              status=status, mimetype='application/json')
+
+poller_thread = threading.Thread(target=poll_device)
+poller_thread.daemon = True
+poller_thread.start()
+
+writer_thread = threading.Thread(target=write_entries)
+writer_thread.daemon = True
+writer_thread.start()
+
+purge_thread = threading.Thread(target=purge_loop)
+purge_thread.daemon = True
+purge_thread.start()
 
 @app.route('/')
 def index():
     try:
-        # Get the most recent data from JSON instead of querying device
-        with file_lock:
-            with open(JSON_FILE, 'r') as f:
-                all_data = json.load(f)
+        # Get the most recent stored reading instead of querying device
+        latest = history_store.latest()
         
-        if all_data:
-            latest = all_data[-1]['data']
+        if latest:
             return render_template('dashboard.html',
-                                is_on=latest['is_on'],
+                                is_on=bool(latest['is_on']),
                                 current_ma=latest['current_ma'],
                                 power_w=latest['power_w'],
                                 voltage_v=latest['voltage_v'],
@@ -205,22 +624,24 @@ def live_data():
     try:
         # Use cached device status (refreshes every 10 seconds)
         data = get_cached_device_status()
-        return jsonify({
+        response = json_response({
             'is_on': bool(data.get('1', False)),
             'power': float(data.get('19', 0))/10,
             'voltage': float(data.get('20', 0))/10,
             'current': float(data.get('18', 0)),
             'total_kwh': float(data.get('17', 0))/1000
         })
+        # Let browsers reuse a reading instead of re-polling within 5 seconds
+        response.headers['Cache-Control'] = 'max-age=5, public'
+        return response
     except Exception as e:
-        return jsonify({'error': str(e)}), 500
+        return json_response({'error': str(e)}, 500)
 
 @app.route('/history')
 def history():
     try:
         days = int(request.args.get('days', 7))
-        historical_data = get_historical_data(days)
-        analysis = analyze_data(historical_data)
+        analysis = get_cached_analysis(days)
         return render_template('history.html', analysis=analysis)
     except Exception as e:
         return f"Error: {str(e)}", 500
@@ -229,44 +650,34 @@ def history():
 def historical_data():
     try:
         date = request.args.get('date')
-        with file_lock:
-            with open(JSON_FILE, 'r') as f:
-                all_data = json.load(f)
-        
-        selected_data = [
-            entry for entry in all_data 
-            if datetime.fromisoformat(entry['timestamp']).strftime('%Y-%m-%d') == date
-        ]
+        try:
+            day = datetime.strptime(date, '%Y-%m-%d')
+        except (TypeError, ValueError):
+            return json_response({'error': 'No data for selected date'}, 404)
+        start = int(day.timestamp())
+        end = int((day + timedelta(days=1)).timestamp())
         
-        if not selected_data:
-            return jsonify({'error': 'No data for selected date'}), 404
+        window = history_store.window(start, end)
+        ts = window['ts']
         
-        total_watt_hours = 0
-        previous_time = None
-        previous_power = None
+        if not ts.size:
+            return json_response({'error': 'No data for selected date'}, 404)
         
-        for entry in selected_data:
-            current_time = datetime.fromisoformat(entry['timestamp'])
-            power = entry['data']['power_w']
-            
-            if previous_time and previous_power is not None:
-                time_diff_hours = (current_time - previous_time).total_seconds() / 3600
-                total_watt_hours += (previous_power + power) / 2 * time_diff_hours
-            
-            previous_time = current_time
-            previous_power = power
+        hours = ts.astype(np.float64) / 3600
+        total_watt_hours = float(trapezoid(window['power_w'], x=hours))
         
         total_kwh = round(total_watt_hours / 1000, 3)
         
-        return jsonify({
-            'timestamps': [datetime.fromisoformat(e['timestamp']).strftime('%H:%M') for e in selected_data],
-            'power': [e['data']['power_w'] for e in selected_data],
-            'voltage': [e['data']['voltage_v'] for e in selected_data],
-            'current': [e['data']['current_ma']/1000 for e in selected_data],
+        # Columns go to orjson as arrays; only the labels need a list of str
+        return json_response({
+            'timestamps': window['hhmm'].astype('U5').tolist(),
+            'power': np.round(window['power_w'].astype(np.float64), 1),
+            'voltage': np.round(window['voltage_v'].astype(np.float64), 1),
+            'current': np.round(window['current_ma'].astype(np.float64) / 1000, 3),
             'total_kwh': total_kwh
         })
     except Exception as e:
-        return jsonify({'error': str(e)}), 500
+        return json_response({'error': str(e)}, 500)
     
 @app.route('/manual')
 def manual():
@@ -276,14 +687,14 @@ def manual():
 def turn_on():
     if device:
         device.set_status(True, '1')
-        get_cached_device_status.cache_clear()
+        invalidate_device_status()
     return redirect(url_for('index'))
 
 @app.route('/off')
 def turn_off():
     if device:
         device.set_status(False, '1')
-        get_cached_device_status.cache_clear()
+        invalidate_device_status()
     return redirect(url_for('index'))
 
 if __name__ == '__main__':
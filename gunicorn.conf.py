@@ -0,0 +1,8 @@
+# Run with: gunicorn app:app
+# A single worker keeps one in-process history cache and one set of
+# poller/writer threads; the handlers are I/O-bound, so threads scale.
+bind = '0.0.0.0:5000'
+workers = 1
+worker_class = 'gthread'
+threads = 8
+keepalive = 65  # Reuse connections across dashboard polls